@@ -5,7 +5,9 @@ Created on Thu Jan 10 10:01:56 2019
 """
 
 
+import numpy as onp
 import jax.numpy as np, jax.scipy as sp, jax.scipy.stats as stats
+from jax import tree_util
 from jax.experimental.vectorize import vectorize
 from scipy.optimize import minimize
 from scipy.stats import multivariate_normal
@@ -27,7 +29,66 @@ def median_heuristic(data, distance, per_dimension = True):
             return median_heuristic(data_dim[:, None], dist_fn, per_dimension = False)
         return np.apply_along_axis(single_dim_heuristic, 0, data)
 
+class _StaticAttr(object):
+    """Wrapper for a static kernel attribute in the auxiliary data of the kernel pytree.
+    Compares by value if the attribute is hashable (lists are compared as tuples, non-floating point arrays by their contents), otherwise by identity.
+    """
+    def __init__(self, value):
+        self.value = value
+        if isinstance(value, (np.ndarray, onp.ndarray)):
+            value = onp.asarray(value)
+            key = (value.dtype.str, value.shape, value.tobytes())
+        else:
+            key = tuple(value) if isinstance(value, list) else value
+        try:
+            hash(key)
+            self.__key = (type(value), key)
+        except TypeError:
+            self.__key = (type(value), id(value))
+
+    def __eq__(self, other):
+        return isinstance(other, _StaticAttr) and self.__key == other.__key
+
+    def __hash__(self):
+        return hash(self.__key)
+
+def _is_kernel_param(value):
+    # only floating point arrays are parameters; integer arrays are structural (e.g. index bounds) and stay static
+    if isinstance(value, (list, tuple)):
+        return len(value) > 0 and all(_is_kernel_param(v) for v in value)
+    if isinstance(value, (np.ndarray, onp.ndarray)):
+        return np.issubdtype(value.dtype, np.inexact)
+    return isinstance(value, Kernel)
+
+def _flatten_kernel(kern):
+    # floating point array attributes (and nested kernels) are the leaves, everything else is static.
+    # Kernels rebuilt by _unflatten_kernel may hold arbitrary objects as leaves (e.g. during vmap), so they keep their split.
+    attrs = sorted((key, value) for (key, value) in kern.__dict__.items() if key != "_param_keys")
+    param_keys = kern.__dict__.get("_param_keys")
+    if param_keys is None:
+        param_keys = tuple(key for (key, value) in attrs if _is_kernel_param(value))
+    static = tuple((key, _StaticAttr(value)) for (key, value) in attrs if key not in param_keys)
+    return ([kern.__dict__[key] for key in param_keys], (param_keys, static))
+
+def _unflatten_kernel(cls, aux, params):
+    (param_keys, static) = aux
+    kern = object.__new__(cls)
+    kern.__dict__.update(zip(param_keys, params))
+    kern.__dict__.update((key, value.value) for (key, value) in static)
+    kern._param_keys = param_keys
+    return kern
+
 class Kernel(object):
+    """Base class of kernels.
+    Kernels are pytrees with their floating point array attributes as leaves, so they can be passed to jitted functions as ordinary arguments and parameter changes (e.g. through set_params) never hit stale compiled code.
+    Kernels that can not be evaluated on traced arrays (e.g. wrapping non-JAX code) set `traceable` to False and are always evaluated eagerly.
+    """
+    traceable = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tree_util.register_pytree_node(cls, _flatten_kernel, lambda aux, params: _unflatten_kernel(cls, aux, params))
+
     def __call__(self, *args, **kwargs):
         return self.gram(*args, **kwargs)
 
@@ -309,6 +370,8 @@ def test_SplitDimsKernel():
                 
 
 class SKlKernel(Kernel):
+    traceable = False
+
     def __init__(self, sklearn_kernel):
         self.skl = sklearn_kernel
 
@@ -1,7 +1,12 @@
+import jax
 import jax.numpy as np
+import weakref
+from functools import partial
+from jax import jit, vmap, lax
+from jax.scipy.linalg import cho_factor, cho_solve, solve_triangular
 
 from typing import TypeVar,  Generic
-from jaxrk.rkhs.vector import FiniteVec, inner
+from jaxrk.rkhs.vector import FiniteVec, inner, _inner_simple, _gram_dtype, _kernel_state, _same_inputs, _traceable, _call_kernel_helper
 
 from .base import Op, Vec, RkhsObject
 from scipy.optimize import minimize
@@ -12,10 +17,81 @@ IntermVecT = TypeVar("IntermVecT", bound=Vec)
 OutVecT = TypeVar("OutVecT", bound=Vec)
 
 
+@jit
+def _reg_shift(G, regul):
+    """Compute G + regul * I by shifting the diagonal, without allocating an identity matrix.
+    The result is at least in single precision, as the regularized matrix is used in solves.
+    """
+    G = G.astype(np.promote_types(G.dtype, np.float32))
+    return G.at[np.diag_indices(len(G))].add(regul)
+
+def _psd_factor(G):
+    """Factorize the symmetric matrix G for repeated solves.
+    Uses a Cholesky factorization. If G is not numerically positive definite (e.g. a barely regularized gram matrix in single precision), solves fall back to an LU based solve.
+    The fallback is chosen on device by _psd_solve, so this is traceable and does not wait for the factorization to finish.
+    """
+    (chol, lower) = cho_factor(G)
+    return (np.all(np.isfinite(chol)), chol, lower, G)
+
+def _psd_solve(fact, rhs):
+    (chol_ok, chol, lower, G) = fact
+    return lax.cond(chol_ok, lambda r: cho_solve((chol, lower), r), lambda r: np.linalg.solve(G, r), rhs)
+
+def _cmo_gram_chol(kern, inspace_points, regul):
+    prefactors = np.ones(len(inspace_points)) / len(inspace_points)
+    dtype = _gram_dtype(prefactors, inspace_points)
+    G = _reg_shift(_call_kernel_helper(_inner_simple, kern, inspace_points, inspace_points, prefactors, prefactors, dtype, dtype), regul)
+    return (G, cho_factor(G)[0])
+
+@jit
+def _cmo_gram_chol_batched(kern, inspace_points, regul):
+    return vmap(lambda X: _cmo_gram_chol(kern, X, regul))(inspace_points)
+
+def _cmo_apply_system(kern, regul, inp_points, query_points):
+    """Regularized gram matrix of the input points and right hand side for the query points."""
+    prefactors = np.ones(len(inp_points)) / len(inp_points)
+    dtype = _gram_dtype(prefactors, inp_points)
+    G = _inner_simple(kern, inp_points, inp_points, prefactors, prefactors, dtype, dtype)
+    rhs = _inner_simple(kern, inp_points, query_points, prefactors, np.ones(len(query_points), dtype), dtype, dtype)
+    return (_reg_shift(G, regul), rhs)
+
+def _cmo_apply_mean(alpha, outp_points):
+    return (alpha.T @ outp_points) / alpha.sum(0)[:, np.newaxis]
+
+@jit
+def _cmo_apply(kern, regul, inp_points, outp_points, query_points):
+    (G, rhs) = _cmo_apply_system(kern, regul, inp_points, query_points)
+    return _cmo_apply_mean(_psd_solve(_psd_factor(G), rhs), outp_points)
+
+@jit
+def _cmo_apply_batched(kern, regul, inp_points, outp_points, query_points):
+    (G, rhs) = vmap(_cmo_apply_system, in_axes = (None, None, 0, 0))(kern, regul, inp_points, query_points)
+    chol = vmap(lambda G: cho_factor(G)[0])(G)
+    # decide on the fallback once for the whole batch: under vmap, a per slice lax.cond would evaluate both branches
+    alpha = lax.cond(np.all(np.isfinite(chol)),
+                     lambda: vmap(lambda c, r: cho_solve((c, False), r))(chol, rhs),
+                     lambda: np.linalg.solve(G, rhs))
+    return vmap(_cmo_apply_mean)(alpha, outp_points)
+
+def build_cmo_apply(kern, regul = 0.01, batched = False):
+    """Build a jitted function `f(inp_points, outp_points, query_points)` returning the conditional mean of the output points at each row of `query_points`.
+    The result matches the means of `multiply(Cmo(FiniteVec(kern, inp_points), FiniteVec(outp_kern, outp_points), regul), FiniteVec(kern, query_points)).normalized()`,
+    but gram matrices, factorization and solve are compiled into one XLA computation specialized to the argument shapes.
+    If `batched` is True, all arguments carry an additional leading axis and one conditional mean operator is applied per slice.
+    The kernel has to be traceable.
+    """
+    assert(_traceable(kern))
+    regul = np.array(regul, dtype=np.float32)
+    f = _cmo_apply_batched if batched else _cmo_apply
+    return lambda inp_points, outp_points, query_points: f(kern, regul, inp_points, outp_points, query_points)
 
 class FiniteOp(Op[InpVecT, OutVecT]):
     """Finite rank RKHS operator
     """
+    _matr_implicit = None # function computing matr @ rhs, if matr is only stored implicitly (e.g. through a factorization of its inverse)
+    _matr_diag = None # diagonal of matr, if matr is known to be a diagonal matrix
+    _solve_fact = None # factorization used by solve, computed on first use
+
     def __init__(self, inp_feat:InpVecT, outp_feat:OutVecT, matr:np.array):
         self.inp_feat = inp_feat
         self.outp_feat = outp_feat
@@ -23,10 +99,38 @@ class FiniteOp(Op[InpVecT, OutVecT]):
     
     def __len__(self):
         return len(self.inp_feat)
+
+    @property
+    def matr(self):
+        if self._matr is None:
+            self._matr = self._matr_implicit(np.eye(len(self.inp_feat)))
+        return self._matr
+
+    @matr.setter
+    def matr(self, matr):
+        self._matr = matr
+        self._matr_implicit = self._matr_diag = self._solve_fact = None
+
+    def apply_matr(self, rhs):
+        """Compute `self.matr @ rhs` without materializing `self.matr` if it is only stored implicitly.
+        """
+        if self._matr_implicit is None:
+            return self.matr @ rhs
+        return self._matr_implicit(rhs)
     
     def solve(self, result:FiniteVec):
-        if np.all(self.outp_feat.inspace_points == result.inspace_points):
-            s = np.linalg.solve(self.matr @ inner(self.inp_feat, self.inp_feat), result.prefactors)
+        (pts, res_pts) = (self.outp_feat.inspace_points, result.inspace_points)
+        if pts is res_pts or (pts.shape == res_pts.shape and np.all(pts == res_pts)):
+            if self._matr_diag is not None:
+                # diag(d) @ G @ s = r  <=>  G @ s = r / d
+                if self._solve_fact is None:
+                    self._solve_fact = _psd_factor(inner(self.inp_feat, self.inp_feat))
+                s = _psd_solve(self._solve_fact, result.prefactors / self._matr_diag)
+            else:
+                if self._solve_fact is None:
+                    self._solve_fact = np.linalg.qr(self.matr @ inner(self.inp_feat, self.inp_feat))
+                (Q, R) = self._solve_fact
+                s = solve_triangular(R, Q.T @ result.prefactors)
             return FiniteVec.construct_RKHS_Elem(result.k, result.inspace_points, s)
         else:
             assert()
@@ -40,12 +144,14 @@ class CrossCovOp(FiniteOp[InpVecT, OutVecT]):
         self.inp_feat = inp_feat
         self.outp_feat = outp_feat
         self.matr = np.diag((inp_feat.prefactors + outp_feat.prefactors)/2)
+        self._matr_diag = (inp_feat.prefactors + outp_feat.prefactors)/2
         self.regul = regul
 
 class CovOp(FiniteOp[InpVecT, InpVecT]):
     def __init__(self, inp_feat:InpVecT, regul = 0.01):
         self.inp_feat = self.outp_feat = self.inp_feat = inp_feat.updated(np.ones(len(inp_feat),dtype = inp_feat.prefactors.dtype))
         self.matr = np.diag(inp_feat.prefactors)
+        self._matr_diag = inp_feat.prefactors
         self._inv = None
         self.regul = regul
     
@@ -56,10 +162,15 @@ class CovOp(FiniteOp[InpVecT, InpVecT]):
 
     def inv(self):
         if self._inv is None:
-            inv_gram = np.linalg.inv(inner(self.inp_feat) + self.regul * np.eye(len(self.inp_feat), dtype = self.matr.dtype))
-            matr = (self.matr**2 @ inv_gram @ inv_gram)
+            fact = _psd_factor(_reg_shift(inner(self.inp_feat), self.regul))
+            diag = self._matr_diag if self._matr_diag is not None else np.diagonal(self.matr)
+
+            def apply_inv(rhs):
+                # matr of the inverse is diag(d**2) @ (G + regul * I)^{-2}, which is never materialized unless requested
+                return (diag**2).reshape((-1,) + (1,) * (np.ndim(rhs) - 1)) * _psd_solve(fact, _psd_solve(fact, rhs))
             self._inv = CovOp(self.inp_feat, self.regul)
-            self._inv.matr = matr
+            self._inv._matr = self._inv._matr_diag = None
+            self._inv._matr_implicit = apply_inv
             self._inv._inv = self
         return self._inv
         
@@ -77,7 +188,51 @@ class Cmo(FiniteOp[InpVecT, OutVecT]):
                                                           op.outp_feat,
                                                           op.matr)
         else:
-            self.matr = np.linalg.inv(inner(self.inp_feat) + regul * np.eye(len(inp_feat)))
+            self._matr_implicit = partial(_psd_solve, _psd_factor(_reg_shift(inner(self.inp_feat), regul)))
+            self._matr = None
+
+    @classmethod
+    def batched(cls, inp_kern, inp_points, outp_kern, outp_points, regul = 0.01):
+        """Construct one conditional mean operator per slice along the leading axis of `inp_points` and `outp_points`, using FiniteVecs as input and output features.
+        The gram matrices of all slices are computed and factorized in a single jitted and vectorized call (one call per slice for kernels that are not traceable).
+        The stacked results are split in one pass; constructing the operators and their FiniteVecs remains a Python loop, i.e. O(B) object overhead for B slices.
+        """
+        assert(len(inp_points) == len(outp_points))
+        regul = np.array(regul, dtype=np.float32)
+        if _traceable(inp_kern):
+            (grams, chols) = _cmo_gram_chol_batched(inp_kern, inp_points, regul)
+        else:
+            (grams, chols) = map(np.stack, zip(*[_cmo_gram_chol(inp_kern, X, regul) for X in inp_points]))
+        chol_ok = np.all(np.isfinite(chols), axis = (1, 2))
+        rval = []
+        for (X, Y, ok, chol, G) in zip(*map(list, (inp_points, outp_points, chol_ok, chols, grams))):
+            # bypass __init__, which would recompute the factorization
+            cmo = cls.__new__(cls)
+            cmo.inp_feat = FiniteVec(inp_kern, X)
+            cmo.outp_feat = FiniteVec(outp_kern, Y)
+            cmo._matr_implicit = partial(_psd_solve, (ok, chol, False, G))
+            cmo._matr = None
+            rval.append(cmo)
+        return rval
+
+_covop_inv_cache = {}
+
+def _cached_covop_inv(ref_feat, regul):
+    """Return `CovOp(ref_feat, regul).inv()`, shared between all callers using the same `ref_feat` and regularization.
+    Entries are dropped when `ref_feat` is garbage collected and recomputed when its points, prefactors, kernel or kernel parameters changed.
+    """
+    (kernel_objs, kernel_static) = _kernel_state(ref_feat.k)
+    inputs = ((ref_feat.inspace_points, ref_feat.prefactors) + kernel_objs, kernel_static)
+    if any(isinstance(a, jax.core.Tracer) for a in inputs[0] + (regul,)):
+        # never cache traced values
+        return CovOp(ref_feat, regul).inv()
+    key = (id(ref_feat), float(regul))
+    entry = _covop_inv_cache.get(key)
+    if entry is not None and entry[0]() is ref_feat and _same_inputs(entry[1], inputs):
+        return entry[2]
+    rval = CovOp(ref_feat, regul).inv()
+    _covop_inv_cache[key] = (weakref.ref(ref_feat, lambda _: _covop_inv_cache.pop(key, None)), inputs, rval)
+    return rval
 
 class Cdo(FiniteOp[InpVecT, OutVecT]):
     """conditional density operator
@@ -85,7 +240,7 @@ class Cdo(FiniteOp[InpVecT, OutVecT]):
     def __init__(self, inp_feat:InpVecT, outp_feat:OutVecT, ref_feat:OutVecT, regul = 0.01):
         
         if True:
-            op = multiply(CovOp(ref_feat, regul).inv(), Cmo(inp_feat, outp_feat, regul))
+            op = multiply(_cached_covop_inv(ref_feat, regul), Cmo(inp_feat, outp_feat, regul))
             (self.inp_feat, self.outp_feat, self.matr) = (op.inp_feat,
                                                           op.outp_feat,
                                                           op.matr)
@@ -108,14 +263,18 @@ class HsTo(FiniteOp[InpVecT, InpVecT]):
         self.embedded = embedded
         self.koopman = koopman
         assert(start_feat.k == timelagged_feat.k)
+        G_x = inner(start_feat)
+        fact = _psd_factor(_reg_shift(G_x, len(timelagged_feat) * regul))
         if (embedded is True and koopman is False) or (embedded is False and koopman is True):
-            self.matr = np.linalg.inv(inner(start_feat) + timelagged_feat * regul * np.eye(len(start_feat)))
+            self._matr_implicit = partial(_psd_solve, fact)
+            self._matr = None
         else:
             G_xy = inner(start_feat, timelagged_feat)
-            G_x = inner(start_feat)
-            self.matr = (np.linalg.pinv(G_xy)
-                         @ np.linalg.pinv(G_x+ len(timelagged_feat) * regul * np.eye(len(timelagged_feat))) 
-                         @ G_xy)
+            # pseudo-inverse of G_xy from its SVD, applied without forming it explicitly
+            (U, s, Vt) = np.linalg.svd(G_xy, full_matrices = False)
+            rcond = 10 * max(G_xy.shape) * np.finfo(G_xy.dtype).eps
+            s_inv = np.where(s > rcond * s.max(), 1. / s, 0.)
+            self.matr = Vt.T @ (s_inv[:, np.newaxis] * (U.T @ _psd_solve(fact, G_xy)))
             if koopman is True:
                 self.matr = self.matr.T
 
@@ -131,10 +290,11 @@ CombT = TypeVar("CombT", FiniteOp[InpVecT, IntermVecT], IntermVecT)
 
 def multiply(A:FiniteOp[IntermVecT, OutVecT], B:CombT) -> RkhsObject: # "T = TypeVar("T"); multiply(A:FiniteOp, B:T) -> T"
     if isinstance(B, FiniteOp):
-        return FiniteOp(B.inp_feat, A.outp_feat, A.matr @ inner(A.inp_feat, B.outp_feat) @ B.matr)
+        return FiniteOp(B.inp_feat, A.outp_feat, A.apply_matr(inner(A.inp_feat, B.outp_feat) @ B.matr))
     else:
         if len(B) == 1:
-            return FiniteVec.construct_RKHS_Elem(A.outp_feat.k, A.outp_feat.inspace_points, np.squeeze(A.matr @ inner(A.inp_feat, B)))
+            return FiniteVec.construct_RKHS_Elem(A.outp_feat.k, A.outp_feat.inspace_points, np.squeeze(A.apply_matr(inner(A.inp_feat, B))))
         else:
-            pref = A.matr @ inner(A.inp_feat, B)
-            return FiniteVec(A.outp_feat.k, np.tile(A.outp_feat.inspace_points, (pref.shape[1], 1)), np.hstack(pref.T), points_per_split=pref.shape[0])
\ No newline at end of file
+            pref = A.apply_matr(inner(A.inp_feat, B))
+            (pts, (n, nvecs)) = (A.outp_feat.inspace_points, pref.shape)
+            return FiniteVec(A.outp_feat.k, np.broadcast_to(pts, (nvecs,) + pts.shape).reshape((-1, pts.shape[1])), pref.T.reshape(-1), points_per_split=n)
\ No newline at end of file
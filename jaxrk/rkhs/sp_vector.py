@@ -124,7 +124,7 @@ class RolloutSpVec(object):
         gram = self._cmo.inp_feat._inner_process_raw(self._current_raw)
         self.current_outp_emb =  FiniteVec.construct_RKHS_Elem(self._cmo.outp_feat.k,
                                                                 self._cmo.outp_feat.inspace_points,
-                                                                np.squeeze(self._cmo.matr @ gram))
+                                                                np.squeeze(self._cmo.apply_matr(gram)))
 
     def update(self, new_point):
         new_idx_obs = np.array((self._next_idx, new_point)).reshape(1,-1)
@@ -163,4 +163,4 @@ class RolloutSpVec(object):
 
         self._num_obs += 1
         inp_gram = self._spvec_history._inner_process_raw(self._current_raw).squeeze()
-        self.current_outp_emb = self.current_outp_emb.updated(self._cmo.matr @ inp_gram)
\ No newline at end of file
+        self.current_outp_emb = self.current_outp_emb.updated(self._cmo.apply_matr(inp_gram))
\ No newline at end of file
@@ -4,25 +4,115 @@ import jax.numpy as np
 from numpy.random import rand
 
 import jax
+import weakref
 from time import time
-from jax import grad
+from functools import partial
+from jax import jit, vmap, lax
 from jax.numpy import dot, log
 from jax.scipy.special import logsumexp
 #from jaxrk.utilities.frank_wolfe import frank_wolfe_unsigned_projection
 
-from typing import Generic, TypeVar
+from typing import Generic, TypeVar, Sequence
 
 from .base import Vec, Op, RkhsObject
 
-def __casted_output(function):
-    return lambda x: onp.asarray(function(x), dtype=np.float64)
+def _gram_dtype(*arrays):
+    """Floating point dtype in which to evaluate gram matrices for vectors built from the given arrays."""
+    return np.result_type(*[a.dtype for a in arrays], np.float32)
+
+def _kernel_state(kernel):
+    """Everything evaluations of kernel depend on, as a pair of objects compared by identity (the kernel and its parameter arrays) and static data compared by value."""
+    (params, structure) = jax.tree_util.tree_flatten(kernel)
+    return ((kernel,) + tuple(params), structure)
+
+def _same_inputs(inp1, inp2):
+    """Compare cache keys of the form (objects compared by identity, static data compared by value)."""
+    return (inp1[1] == inp2[1] and len(inp1[0]) == len(inp2[0]) and
+            all(a is b for (a, b) in zip(inp1[0], inp2[0])))
+
+def _kernel_gram(kernel, X, Y, dtype):
+    gram = kernel(X, Y)
+    if gram.dtype != dtype:
+        gram = gram.astype(dtype)
+    return gram
+
+def _traceable(kernel):
+    """Whether kernel can be evaluated on traced arrays, i.e. passed to the jitted helpers below."""
+    return getattr(kernel, "traceable", False)
+
+def _call_kernel_helper(helper, kernel, *args):
+    """Call one of the jitted helpers below, or its undecorated function for kernels that can only be evaluated eagerly."""
+    if _traceable(kernel):
+        return helper(kernel, *args)
+    return helper.__wrapped__(kernel, *args)
+
+# kernels are pytrees and passed to the jitted helpers as traced arguments
+# dtype is the dtype of the gram matrix, accum_dtype the one in which the reductions accumulate
+
+@partial(jit, static_argnums=(5, 6))
+def _inner_simple(kernel, X, Y, prefactors_X, prefactors_Y, dtype, accum_dtype):
+    gram = _kernel_gram(kernel, X, Y, dtype)
+    return np.einsum("ij,i,j->ij", gram, prefactors_X, prefactors_Y, preferred_element_type = accum_dtype)
+
+# prefactors of the balanced helpers are laid out as (splits, points_per_split), simple vectors have a single point per split
+
+@partial(jit, static_argnums=(5, 6))
+def _inner_balanced(kernel, X, Y, prefactors_X, prefactors_Y, dtype, accum_dtype):
+    gram = _kernel_gram(kernel, X, Y, dtype).reshape(prefactors_X.shape + prefactors_Y.shape)
+    return np.einsum("apbq,ap,bq->ab", gram, prefactors_X, prefactors_Y, preferred_element_type = accum_dtype)
+
+@partial(jit, static_argnums=(3, 4))
+def _inner_diag(kernel, X, prefactors, dtype, accum_dtype):
+    (nsplits, pps) = prefactors.shape
+    if pps == 1:
+        # one point per split, so only the kernel diagonal is needed
+        k_diag = kernel(X, diag = True).astype(dtype)
+        return np.einsum("a,a,a->a", k_diag, prefactors[:, 0], prefactors[:, 0], preferred_element_type = accum_dtype)
+    # only the diagonal blocks of the gram matrix, one per split
+    block = lambda X_split: _kernel_gram(kernel, X_split, X_split, dtype)
+    X_splits = X.reshape((nsplits, pps, -1))
+    blocks = vmap(block)(X_splits) if _traceable(kernel) else np.stack([block(X_split) for X_split in X_splits])
+    return np.einsum("apq,ap,aq->a", blocks, prefactors, prefactors, preferred_element_type = accum_dtype)
+
+@partial(jit, static_argnums=2)
+def _reduce_balanced(gram, prefactors, axis):
+    (nsplits, pps) = prefactors.shape
+    dtype = np.result_type(gram, prefactors)
+    (gram, prefactors) = (gram.astype(dtype), prefactors.astype(dtype))
+    # batch over splits and contract the points within each split
+    if axis == 0:
+        return lax.dot_general(gram.reshape((nsplits, pps, -1)), prefactors, (((1,), (1,)), ((0,), (0,))))
+    else:
+        return lax.dot_general(gram.reshape((-1, nsplits, pps)), prefactors, (((2,), (1,)), ((1,), (0,)))).T
+
+@partial(jit, static_argnums=(5, 6, 7))
+def _inner_tiled(kernel, X, Y, prefactors_X, prefactors_Y, dtype, accum_dtype, tile):
+    (nsplits, pps_X) = prefactors_X.shape
+    splits_per_tile = max(tile // pps_X, 1)
+    ntiles = -(-nsplits // splits_per_tile)
+    # pad X to a whole number of tiles; padded points get prefactor zero and are cut from the result
+    pad = ntiles * splits_per_tile * pps_X - len(X)
+    X_tiles = np.pad(X, ((0, pad), (0, 0))).reshape((ntiles, splits_per_tile * pps_X, X.shape[1]))
+    prefactors_X_tiles = np.pad(prefactors_X, ((0, pad // pps_X), (0, 0))).reshape((ntiles, splits_per_tile, pps_X))
+
+    def tile_inner(carry, tile_inp):
+        (X_tile, prefactors_tile) = tile_inp
+        gram = _kernel_gram(kernel, X_tile, Y, dtype).reshape(prefactors_tile.shape + prefactors_Y.shape)
+        return carry, np.einsum("apbq,ap,bq->ab", gram, prefactors_tile, prefactors_Y, preferred_element_type = accum_dtype)
+    if _traceable(kernel):
+        (_, rval) = lax.scan(tile_inner, None, (X_tiles, prefactors_X_tiles))
+    else:
+        rval = np.stack([tile_inner(None, tile_inp)[1] for tile_inp in zip(X_tiles, prefactors_X_tiles)])
+    return rval.reshape((ntiles * splits_per_tile, -1))[:nsplits]
 
 
 class FiniteVec(Vec):
     """
         RKHS feature vector using input space points. This is the simplest possible vector.
+        If cache_self_gram is True, the kernel gram matrix of the input space points is computed once at construction and reused by inner() and by vectors obtained from updated().
+        With precision "mixed_bf16", the kernel is evaluated on bfloat16 inputs and its gram matrices are stored in bfloat16 (including K_self), while prefactors and reductions stay in (at least) float32.
     """
-    def __init__(self, kern, inspace_points, prefactors = None, points_per_split = None):
+    def __init__(self, kern, inspace_points, prefactors = None, points_per_split = None, cache_self_gram = False, precision = "default"):
         row_splits = None
         self.k = kern
         self.inspace_points = inspace_points
@@ -35,10 +125,21 @@ class FiniteVec(Vec):
 
         assert(prefactors.shape[0] == len(inspace_points))
         assert(len(prefactors.shape) == 1)
-        self.prngkey = jax.random.PRNGKey(np.int64(time()))
+        self._prngkey = None
         self.__reconstruction_kwargs = {}
 
+        assert(precision in ("default", "mixed_bf16"))
+        self.precision = precision
+        if precision != "default":
+            self.__reconstruction_kwargs["precision"] = precision
+
         self.prefactors = prefactors
+        self._dtype = _gram_dtype(self.prefactors, self.inspace_points)
+        self._self_gram = None
+        self._cross_gram_cache = {}
+        self._K_self = None
+        if cache_self_gram:
+            self.__compute_K_self()
 
 
         if (points_per_split is not None) or (row_splits is not None):
@@ -61,22 +162,31 @@ class FiniteVec(Vec):
                 self.normalized = self.__normalized_ragged__
                 self.__reconstruction_kwargs["row_splits"] = row_splits
         else:
-            self.__reduce_gram__ = lambda gram, axis: gram
+            self.__reduce_gram__ = self.__reduce_simple__
             self.is_simple = True
             self.__len = len(self.inspace_points)
 
+    @property
+    def _fingerprint(self):
+        """Identities of the arrays and kernel defining this vector. Computed on access, as these attributes may be reassigned."""
+        return (id(self.inspace_points), id(self.prefactors), id(self.k))
+
     def __eq__(self, other):
-        return (isinstance(other, self.__class__) and
+        if not isinstance(other, self.__class__):
+            return False
+        if other._fingerprint == self._fingerprint:
+            return True
+        return (other.k == self.k and
+                other.prefactors.shape == self.prefactors.shape and
+                other.inspace_points.shape == self.inspace_points.shape and
                 np.all(other.prefactors == self.prefactors) and
-                np.all(other.inspace_points == self.inspace_points) and
-                other.k == self.k)
+                np.all(other.inspace_points == self.inspace_points))
 
     def __len__(self):
         return self.__len
     
     def __normalized_balanced__(self):
-        upd_pref = self.__reshape_balanced__(self.prefactors.reshape((-1, 1)))#.squeeze()
-        upd_pref = upd_pref / upd_pref.sum(1, keepdims=True)
+        upd_pref = self._prefactors_split / self._prefactors_split.sum(1, keepdims=True)
         return self.updated(upd_pref.reshape(self.prefactors.shape))
 
     def __normalized_ragged__(self):
@@ -90,29 +200,136 @@ class FiniteVec(Vec):
         #return tf.RaggedTensor.from_row_splits(values=gram, row_splits=self.row_splits)
     
     def __reduce_balanced_ragged__(self, gram, axis):
-        perm = list(range(len(gram.shape)))
-        perm[0] = axis
-        perm[axis] = 0
+        return _reduce_balanced(gram, self._prefactors_split, axis)
 
-        gram = np.transpose(gram, perm)
-        gram = np.sum(self.__reshape_gram__(gram), axis = 1) 
-        gram =  np.transpose(gram, perm)
-        return gram
+    def __reduce_simple__(self, gram, axis):
+        return np.einsum("ij,i->ij" if axis == 0 else "ij,j->ij", gram, self.prefactors)
     
     def inner(self, Y=None, full=True):
         if not full and Y is not None:
             raise ValueError(
                 "Ambiguous inputs: `diagonal` and `y` are not compatible.")
         if not full:
-            return  self.reduce_gram(self.reduce_gram(self.k(self.inspace_points, full = full), axis = 0), axis = 1)
+            (X, _, prefactors, _, dtype, accum_dtype) = self.__inner_args(self, split = True)
+            return _call_kernel_helper(_inner_diag, self.k, X, prefactors, dtype, accum_dtype)
         if Y is not None:
             assert(self.k == Y.k)
         else:
             Y = self
-        gram = self.k(self.inspace_points, Y.inspace_points).astype(float)
-        r1 = self.reduce_gram(gram, axis = 0)
-        r2 = Y.reduce_gram(r1, axis = 1)
-        return r2
+        inputs = self.__gram_inputs(Y)
+        if Y is self:
+            entry = self._self_gram
+        else:
+            entry = self._cross_gram_cache.get(id(Y))
+            if entry is not None and entry[0]() is Y:
+                entry = entry[1:]
+            else:
+                entry = None
+        if entry is not None and _same_inputs(entry[0], inputs):
+            return entry[1]
+
+        if Y is self and self.__K_self_valid():
+            gram = self.reduce_gram(self.reduce_gram(self.K_self, axis = 0), axis = 1)
+        elif self.is_simple and Y.is_simple:
+            gram = _call_kernel_helper(_inner_simple, self.k, *self.__inner_args(Y, split = False))
+        else:
+            gram = _call_kernel_helper(_inner_balanced, self.k, *self.__inner_args(Y, split = True))
+
+        if not isinstance(gram, jax.core.Tracer):
+            # cache the result; the entry for Y is dropped as soon as Y is garbage collected
+            if Y is self:
+                self._self_gram = (inputs, gram)
+            else:
+                cache, key = self._cross_gram_cache, id(Y)
+                cache[key] = (weakref.ref(Y, lambda _: cache.pop(key, None)), inputs, gram)
+        return gram
+
+    def inner_tiled(self, Y=None, tile = 256):
+        """Compute the same result as self.inner(Y), evaluating the kernel on tiles of about `tile` input space points of self at a time.
+        The full gram matrix between the input space points of self and Y is never materialized, only blocks of `tile` times len(Y.inspace_points).
+        """
+        if Y is not None:
+            assert(self.k == Y.k)
+        else:
+            Y = self
+        return _call_kernel_helper(_inner_tiled, self.k, *self.__inner_args(Y, split = True), tile)
+
+    @property
+    def K_self(self):
+        """Kernel gram matrix of the input space points, computed on first access and cached."""
+        if self.__K_self_valid():
+            return self._K_self[1]
+        return self.__compute_K_self()
+
+    def __compute_K_self(self):
+        """Evaluate the kernel gram matrix of the input space points and cache it, unless it is traced."""
+        if self.precision == "mixed_bf16":
+            X = self.inspace_points.astype(np.bfloat16)
+            K = _kernel_gram(self.k, X, X, np.bfloat16)
+        else:
+            K = self.k(self.inspace_points)
+        if not isinstance(K, jax.core.Tracer):
+            self._K_self = (self.__K_self_inputs(), K)
+        return K
+
+    def __K_self_inputs(self):
+        (kernel_objs, kernel_static) = _kernel_state(self.k)
+        return ((self.inspace_points,) + kernel_objs, kernel_static)
+
+    def __K_self_valid(self):
+        return self._K_self is not None and _same_inputs(self._K_self[0], self.__K_self_inputs())
+
+    @property
+    def prngkey(self):
+        # created on first use rather than in __init__, as creating a key is a device call
+        if self._prngkey is None:
+            self._prngkey = jax.random.PRNGKey(np.int64(time()))
+        return self._prngkey
+
+    @prngkey.setter
+    def prngkey(self, prngkey):
+        self._prngkey = prngkey
+
+    # points and prefactors are stored as (immutable) jax arrays, so cached results can be validated by array identity
+
+    @property
+    def inspace_points(self):
+        return self._inspace_points
+
+    @inspace_points.setter
+    def inspace_points(self, inspace_points):
+        self._inspace_points = np.asarray(inspace_points)
+
+    @property
+    def prefactors(self):
+        return self._prefactors
+
+    @prefactors.setter
+    def prefactors(self, prefactors):
+        self._prefactors = np.asarray(prefactors)
+
+    @property
+    def _prefactors_split(self):
+        """Prefactors laid out as (splits, points_per_split), where simple vectors have a single point per split."""
+        return self.prefactors.reshape((-1, 1 if self.is_simple else self.points_per_split))
+
+    def __inner_args(self, Y, split):
+        """Points, prefactors (flat or split layout), gram dtype and accumulation dtype for the jitted inner product helpers."""
+        if split:
+            (prefactors_X, prefactors_Y) = (self._prefactors_split, Y._prefactors_split)
+        else:
+            (prefactors_X, prefactors_Y) = (self.prefactors, Y.prefactors)
+        dtype = np.promote_types(self._dtype, Y._dtype)
+        if self.precision == "mixed_bf16" or Y.precision == "mixed_bf16":
+            bf16 = np.bfloat16
+            return (self.inspace_points.astype(bf16), Y.inspace_points.astype(bf16), prefactors_X, prefactors_Y, bf16, dtype)
+        return (self.inspace_points, Y.inspace_points, prefactors_X, prefactors_Y, dtype, dtype)
+
+    def __gram_inputs(self, Y):
+        """Everything the result of self.inner(Y) depends on, for validating cached results."""
+        ((kernel_objs_X, kernel_static_X), (kernel_objs_Y, kernel_static_Y)) = (_kernel_state(self.k), _kernel_state(Y.k))
+        return ((self.inspace_points, self.prefactors, Y.inspace_points, Y.prefactors) + kernel_objs_X + kernel_objs_Y,
+                (1 if self.is_simple else self.points_per_split, 1 if Y.is_simple else Y.points_per_split, kernel_static_X, kernel_static_Y))
     
     def normalized(self):
         return self.updated(np.ones_like(self.prefactors))
@@ -129,10 +346,12 @@ class FiniteVec(Vec):
     
     def updated(self, prefactors):
         assert(len(self.prefactors) == len(prefactors))
-        return FiniteVec(self.k, self.inspace_points, prefactors, **self.__reconstruction_kwargs)
+        rval = FiniteVec(self.k, self.inspace_points, prefactors, **self.__reconstruction_kwargs)
+        # the kernel gram matrix does not depend on the prefactors
+        rval._K_self = self._K_self
+        return rval
 
     def reduce_gram(self, gram, axis = 0):
-        gram = gram.astype(self.prefactors.dtype) * np.expand_dims(self.prefactors, axis=(axis+1)%2)
         return self.__reduce_gram__(gram, axis)
     
     def get_mean_var(self, keepdims = False):
@@ -176,32 +395,46 @@ class FiniteVec(Vec):
         return inner(self, FiniteVec(self.k, argument, np.ones(len(argument))))
 
 
-def unsigned_projection(support_points, factors, kernel):
-    G = kernel(support_points).astype(np.float64)
-    c = 2*np.dot(factors, G)
-    cost = lambda f: dot(dot(f, G), f) - dot(c, f)
-    res = osp.optimize.minimize(__casted_output(cost),
-                               rand(len(factors))+ 0.0001,
-                               jac = __casted_output(grad(cost)),
-                               bounds = [(0., None)] * len(factors))
-
+@jit
+@jax.value_and_grad
+def _support_estimate_cost_grad(f, G):
+    #solution evaluated in support points should be positive constant
+    return np.abs(dot(f, G) - 1).sum()
+
+@jit
+@jax.value_and_grad
+def _density_estimate_cost_grad(f, G):
+    #minimum negative log likelihood of support_points under solution
+    return -log(dot(f, G)).sum()
+
+def _minimize_nonneg(cost_and_grad, init, *args):
+    """Minimize over nonnegative vectors using L-BFGS-B, evaluating cost and gradient in a single jitted call per iteration."""
+    def fun(f):
+        (cost, g) = cost_and_grad(f, *args)
+        return (onp.float64(cost), onp.asarray(g, dtype=onp.float64))
+    res = osp.optimize.minimize(fun, init, jac = True, method = "L-BFGS-B", bounds = [(0., None)] * len(init))
     return res["x"]
 
+def unsigned_projection(support_points, factors, kernel):
+    # minimizing f G f - 2 factors G f over f >= 0 is the nonnegative least squares problem
+    # min ||A f - A factors|| with G = A^T A, where A is computed from an eigendecomposition
+    # to be robust against gram matrices that are numerically slightly indefinite
+    G = onp.asarray(kernel(support_points), dtype = onp.float64)
+    (w, V) = onp.linalg.eigh((G + G.T) / 2)
+    A = onp.sqrt(onp.clip(w, 0., None))[:, onp.newaxis] * V.T
+    (f, _) = osp.optimize.nnls(A, A @ onp.asarray(factors, dtype = onp.float64), maxiter = 50 * len(factors))
+    return f
+
 def distr_estimate_optimization(kernel, support_points, est="support"):
     G = kernel(support_points).astype(np.float64)
 
     if est == "support":
-        #solution evaluated in support points should be positive constant
-        cost = lambda f: np.abs(dot(f, G) - 1).sum()
+        cost_and_grad = _support_estimate_cost_grad
     elif est == "density":
-        #minimum negative log likelihood of support_points under solution
-        cost = lambda f: -log(dot(f, G)).sum()
-
-    bounds = [(0., None)] * len(support_points)
+        cost_and_grad = _density_estimate_cost_grad
 
-    res = osp.optimize.minimize(__casted_output(cost), rand(len(support_points))+ 0.0001, jac = __casted_output(grad(cost)), bounds = bounds)
-
-    return res["x"]/res["x"].sum()
+    x = _minimize_nonneg(cost_and_grad, rand(len(support_points))+ 0.0001, G)
+    return x/x.sum()
 
 V1T = TypeVar("V1T")
 V2T = TypeVar("V2T")
@@ -220,12 +453,42 @@ class CombVec(Vec, Generic[V1T, V2T]):
             assert(Y.operation == self.operation)
         return self.operation(self.v1.inner(Y.v1), self.v2.inner(Y.v2))
 
+    def inner_batched(self, Ys:"Sequence[CombVec[V1T, V2T]]"):
+        """Inner products of self with each of the equally shaped vectors in Ys, stacked along the leading axis.
+        All components have to be simple FiniteVecs, which allows computing everything in a single jitted and vectorized call.
+        Kernels that are not traceable fall back to one inner product per element of Ys.
+        """
+        for v in (self.v1, self.v2):
+            assert(isinstance(v, FiniteVec) and v.is_simple)
+        for Y in Ys:
+            assert(Y.operation == self.operation)
+            assert(Y.v1.k == self.v1.k and Y.v2.k == self.v2.k)
+            assert(isinstance(Y.v1, FiniteVec) and Y.v1.is_simple and isinstance(Y.v2, FiniteVec) and Y.v2.is_simple)
+        if not (_traceable(self.v1.k) and _traceable(self.v2.k)):
+            return np.stack([self.inner(Y) for Y in Ys])
+        stacked = [np.stack([getattr(getattr(Y, v), attr) for Y in Ys]) for v in ("v1", "v2") for attr in ("inspace_points", "prefactors")]
+        return _comb_inner_batched(self.operation, self.v1.k, self.v2.k,
+                                   self.v1.inspace_points, self.v1.prefactors,
+                                   self.v2.inspace_points, self.v2.prefactors,
+                                   *stacked)
+
     def __len__(self):
         return self.__len
 
     def updated(self, prefactors):
         raise NotImplementedError()
 
+    def reduce_gram(self, gram, axis = 0):
+        raise NotImplementedError()
+
+
+@partial(jit, static_argnums = 0)
+def _comb_inner_batched(operation, kern_1, kern_2, X_1, prefactors_X_1, X_2, prefactors_X_2, Y_1, prefactors_Y_1, Y_2, prefactors_Y_2):
+    def single(y_1, p_1, y_2, p_2):
+        (dtype_1, dtype_2) = (_gram_dtype(X_1, y_1, prefactors_X_1, p_1), _gram_dtype(X_2, y_2, prefactors_X_2, p_2))
+        return operation(_inner_simple(kern_1, X_1, y_1, prefactors_X_1, p_1, dtype_1, dtype_1),
+                         _inner_simple(kern_2, X_2, y_2, prefactors_X_2, p_2, dtype_2, dtype_2))
+    return vmap(single)(Y_1, prefactors_Y_1, Y_2, prefactors_Y_2)
 
 def inner(X, Y=None, full=True):
     return X.inner(Y, full)
@@ -1,12 +1,13 @@
 import copy
 
+import jax
 import jax.numpy as np
 from numpy.random import randn
 import pytest
 from numpy.testing import assert_allclose
 from jax import random
 
-from jaxrk.rkhs import CovOp, Cdo, Cmo, FiniteOp, FiniteVec, multiply, inner, SpVec, CombVec
+from jaxrk.rkhs import CovOp, Cdo, Cmo, HsTo, FiniteOp, FiniteVec, multiply, inner, SpVec, CombVec, build_cmo_apply
 from jaxrk.kern import (GaussianKernel, SplitDimsKernel, PeriodicKernel)
 from jaxrk.utilities.array_manipulation import all_combinations
 
@@ -62,6 +63,93 @@ def test_FiniteOp():
     assert(np.allclose(multiply(C3, C1).matr, gk_x(rv_fvec.inspace_points, ref_fvec.inspace_points) @ C1.matr), 0.001, 0.001)
 
 
+def test_FiniteOp_solve():
+    gk_x = GaussianKernel(0.5)
+    x = np.linspace(-2.5, 15, 10)[:, np.newaxis]
+    fvec = FiniteVec(gk_x, x, np.arange(1., 11.))
+    r = FiniteVec(gk_x, x, np.linspace(1., 2., 10))
+
+    # diagonal matr, solved through a factorization of the gram matrix
+    C = CovOp(fvec)
+    G = inner(C.inp_feat, C.inp_feat)
+    assert np.allclose(C.solve(r).prefactors, np.linalg.solve(C.matr @ G, r.prefactors), rtol = 1e-4, atol = 1e-5)
+    fact = C._solve_fact
+    C.solve(r)
+    assert C._solve_fact is fact
+
+    # dense matr, solved through a cached QR decomposition
+    matr = np.eye(10) + 0.01 * np.arange(100.).reshape((10, 10))
+    F = FiniteOp(fvec, fvec, matr)
+    G = inner(fvec, fvec)
+    assert np.allclose(F.solve(r).prefactors, np.linalg.solve(matr @ G, r.prefactors), rtol = 1e-4, atol = 1e-5)
+    fact = F._solve_fact
+    F.solve(r)
+    assert F._solve_fact is fact
+
+
+def test_Cmo():
+    gk_x = GaussianKernel(0.5)
+    x = np.linspace(-2.5, 15, 20)[:, np.newaxis].astype(np.float32)
+    y = np.sin(x)
+    invec, outvec = FiniteVec(gk_x, x), FiniteVec(gk_x, y)
+    cm = Cmo(invec, outvec, 0.1)
+    inv_gram = np.linalg.inv(inner(invec) + 0.1 * np.eye(len(x)))
+    assert np.allclose(cm.matr, inv_gram, atol = 1e-4)
+    rhs = inner(invec, FiniteVec.construct_RKHS_Elem(gk_x, x[:3]))
+    assert np.allclose(cm.apply_matr(rhs), inv_gram @ rhs, atol = 1e-4)
+
+    cms = Cmo.batched(gk_x, np.stack([x, x + 1]), gk_x, np.stack([y, y]), 0.1)
+    assert len(cms) == 2
+    assert np.allclose(cms[0].matr, inv_gram, atol = 1e-4)
+    assert np.allclose(cms[1].matr, Cmo(FiniteVec(gk_x, x + 1), outvec, 0.1).matr, atol = 1e-4)
+
+    query = x[::4] + 0.3
+    est = multiply(cm, FiniteVec(gk_x, query)).normalized().get_mean_var()[0]
+    assert np.allclose(build_cmo_apply(gk_x, 0.1)(x, y, query), est[:, np.newaxis], atol = 1e-4)
+    est_batched = build_cmo_apply(gk_x, 0.1, batched = True)(np.stack([x, x]), np.stack([y, 2 * y]), np.stack([query, query]))
+    assert np.allclose(est_batched[1], 2 * est[:, np.newaxis], atol = 1e-4)
+    # an indefinite system (negative regularization) takes the fallback solve for the whole batch
+    est_indef = build_cmo_apply(gk_x, -0.01, batched = True)(np.stack([x, x]), np.stack([y, y]), np.stack([query, query]))
+    assert np.allclose(est_indef[0], build_cmo_apply(gk_x, -0.01)(x, y, query), atol = 1e-4)
+
+    # the whole operator pipeline is traceable
+    pred = lambda x: multiply(Cmo(FiniteVec(gk_x, x), outvec, 0.1), FiniteVec(gk_x, query)).normalized().get_mean_var()[0]
+    assert np.allclose(jax.jit(pred)(x), est, atol = 1e-4)
+    assert np.allclose(jax.jit(lambda x: CovOp(FiniteVec(gk_x, x), 0.1).inv().matr)(x), CovOp(invec, 0.1).inv().matr, atol = 1e-4)
+
+
+def test_HsTo():
+    gk_x = GaussianKernel(0.5)
+    x = np.linspace(0, 5, 30)[:, np.newaxis]
+    (start, lagged) = (FiniteVec(gk_x, x[:-1]), FiniteVec(gk_x, x[1:]))
+    G_xy = inner(start, lagged)
+    reg_inv = np.linalg.inv(inner(start) + len(lagged) * 0.01 * np.eye(len(start)))
+    ref = np.linalg.pinv(G_xy) @ reg_inv @ G_xy
+    for (embedded, koopman, expected) in [(False, False, ref), (True, True, ref.T), (True, False, reg_inv), (False, True, reg_inv)]:
+        assert np.allclose(HsTo(start, lagged, 0.01, embedded, koopman).matr, expected, atol = 1e-3)
+
+
+def test_Cdo_shared_ref_inverse():
+    from jaxrk.rkhs.operator import _cached_covop_inv
+    gk_x = GaussianKernel(0.5)
+    x = np.linspace(-2.5, 15, 20)[:, np.newaxis].astype(np.float32)
+    refvec = FiniteVec(gk_x, np.linspace(-3, 16, 30)[:, np.newaxis])
+    C_inv = _cached_covop_inv(refvec, 0.1)
+    assert _cached_covop_inv(refvec, 0.1) is C_inv
+    assert _cached_covop_inv(refvec, 0.2) is not C_inv
+    assert np.allclose(C_inv.matr, CovOp(refvec, 0.1).inv().matr)
+    (invec, outvec) = (FiniteVec(gk_x, x), FiniteVec(gk_x, np.sin(x)))
+    cd = Cdo(invec, outvec, refvec, 0.1)
+    assert _cached_covop_inv(refvec, 0.1) is C_inv
+    uncached = multiply(CovOp(refvec, 0.1).inv(), Cmo(invec, outvec, 0.1))
+    assert np.allclose(cd.matr, uncached.matr, rtol = 1e-4, atol = 1e-4 * np.abs(uncached.matr).max())
+    refvec.prefactors = refvec.prefactors * 2
+    C_inv2 = _cached_covop_inv(refvec, 0.1)
+    assert C_inv2 is not C_inv
+    refvec.k.set_params(1.)
+    assert _cached_covop_inv(refvec, 0.1) is not C_inv2
+
+
 def test_CovOp(plot = False):   
     from scipy.stats import multivariate_normal
 
@@ -85,10 +173,14 @@ def test_CovOp(plot = False):
     ref_fvec = FiniteVec(gk_x, x, np.ones(len(x)))
     ref_elem = ref_fvec.sum()
 
-    C_ref = CovOp(ref_fvec, regul=0.) # CovOp_compl(out_fvec.k, out_fvec.inspace_points, regul=0.)
+    # unregularized inverse is only well posed for a well conditioned gram matrix, so use a thinned out reference vector
+    sub_fvec = FiniteVec(gk_x, x[::50], np.ones(len(x[::50])))
+    C_ref = CovOp(sub_fvec, regul=0.) # CovOp_compl(out_fvec.k, out_fvec.inspace_points, regul=0.)
 
-    inv_Gram_ref = np.linalg.inv(inner(ref_fvec))
+    inv_Gram_ref = np.linalg.inv(inner(sub_fvec))
     assert(np.allclose((inv_Gram_ref@inv_Gram_ref)/ C_ref.inv().matr, 1., atol = 1e-3))
+    assert(C_ref.inv().inv() is C_ref)
+    assert(np.allclose(C_ref.inv().apply_matr(np.eye(len(inv_Gram_ref))), C_ref.inv().matr))
     #assert(np.allclose(multiply(C_ref.inv(), ref_elem).prefactors, np.sum(np.linalg.inv(inner(ref_fvec)), 0), rtol=1e-02))
 
     C_samps = CovOp(out_fvec, regul=regul_C_ref)
@@ -6,8 +6,11 @@ import pytest
 from numpy.testing import assert_allclose
 
 
-from jaxrk.rkhs import FiniteVec, inner, SpVec
-from jaxrk.kern import GaussianKernel 
+from jax.numpy import multiply, bfloat16
+
+from jaxrk.rkhs import FiniteVec, inner, SpVec, CombVec
+from jaxrk.kern import GaussianKernel, SplitDimsKernel, Kernel
+from jaxrk.kern.base import SKlKernel
 
 rng = np.random.RandomState(1)
 
@@ -85,3 +88,165 @@ def test_Mean_var(D = 1, kernel = kernel_setups[0]):
     m, v = vec.normalized().get_mean_var()
     assert np.allclose(m.flatten(), np.array([0.5, 2./3]))
     assert np.allclose(v.flatten(), kernel.var + np.array([0.5, 2./3]) - m.flatten()**2)
+
+
+def test_CombVec_inner_batched(kernel = kernel_setups[0]):
+    X, Y = rng.randn(5, 2), rng.randn(3, 4, 2)
+    comb = CombVec(FiniteVec(kernel, X[:, :1]), FiniteVec(kernel, X[:, 1:]), multiply)
+    combs_Y = [CombVec(FiniteVec(kernel, y[:, :1]), FiniteVec(kernel, y[:, 1:]), multiply) for y in Y]
+    batched = comb.inner_batched(combs_Y)
+    assert batched.shape == (3, 5, 4)
+    for i in range(3):
+        assert np.allclose(batched[i], comb.inner(combs_Y[i]), atol = 1e-5)
+
+
+def test_inner_cache(kernel = kernel_setups[0]):
+    X = rng.randn(10, 2)
+    rv, rv2 = FiniteVec(kernel, X), FiniteVec(kernel, X + 1)
+    assert inner(rv) is inner(rv)
+    assert inner(rv, rv2) is inner(rv, rv2)
+    old = inner(rv, rv2)
+    rv.prefactors = 2 * rv.prefactors
+    assert np.allclose(inner(rv, rv2), 2 * old)
+
+    # points and prefactors are copied into immutable arrays, so mutating the inputs can not make cached grams stale
+    X_mut = X.copy()
+    mv = FiniteVec(kernel, X_mut, cache_self_gram = True)
+    old = inner(mv)
+    X_mut[0] += 5
+    assert np.allclose(inner(mv), old) and np.allclose(mv.K_self, kernel(X))
+    with pytest.raises(TypeError):
+        mv.inspace_points[0] += 5
+    mv.inspace_points = X_mut
+    assert np.allclose(inner(mv), inner(FiniteVec(kernel, X_mut)))
+
+    # changing the kernel or its parameters invalidates cached grams
+    k = GaussianKernel(0.5)
+    kv = FiniteVec(k, X, cache_self_gram = True)
+    inner(kv)
+    kv.k = GaussianKernel(3.)
+    assert np.allclose(inner(kv), inner(FiniteVec(GaussianKernel(3.), X)))
+    kv.k = k
+    k.set_params(2.)
+    assert np.allclose(kv.K_self, k(X))
+    assert np.allclose(inner(kv), inner(FiniteVec(GaussianKernel(2.), X)))
+
+    cached = FiniteVec(kernel, X, points_per_split = 5, cache_self_gram = True)
+    upd = cached.updated(np.arange(10.))
+    assert upd.K_self is cached.K_self
+    assert np.allclose(inner(upd), inner(FiniteVec(kernel, X, np.arange(10.), points_per_split = 5)))
+
+
+def test_unsigned_projection(kernel = kernel_setups[0]):
+    from scipy.optimize import minimize
+    from jaxrk.rkhs.vector import unsigned_projection
+    X = rng.randn(15, 1)
+    factors = rng.randn(15)
+    G = np.asarray(kernel(X), dtype = np.float64)
+    cost = lambda f: f @ G @ f - 2 * factors @ G @ f
+    ref = minimize(cost, np.ones(15), jac = lambda f: 2 * G @ (f - factors), method = "L-BFGS-B", bounds = [(0., None)] * 15)["x"]
+    f = unsigned_projection(X, factors, kernel)
+    assert np.all(f >= 0)
+    assert cost(f) <= cost(ref) + 1e-6
+
+
+@pytest.mark.parametrize('est', ["support", "density"])
+def test_distr_estimate_optimization(est, kernel = kernel_setups[0]):
+    from jaxrk.rkhs.vector import distr_estimate_optimization
+    x = distr_estimate_optimization(kernel, rng.randn(15, 1), est = est)
+    assert x.shape == (15,)
+    assert np.all(x >= 0)
+    assert np.allclose(x.sum(), 1.)
+
+
+def test_kernel_params_traced():
+    X = rng.randn(10, 2)
+    k = GaussianKernel(0.5)
+    inner(FiniteVec(k, X))
+    k.set_params(3.)
+    assert np.allclose(inner(FiniteVec(k, X)), inner(FiniteVec(GaussianKernel(3.), X)))
+    assert np.allclose(inner(FiniteVec(k, X)), k(X) / 100, atol = 1e-6)
+
+
+class NumpyGaussianKernel(Kernel):
+    # evaluated with plain numpy, so it can not be traced by jax
+    traceable = False
+
+    def gram(self, X, Y = None, diag = False):
+        X = np.asarray(X)
+        Y = X if Y is None else np.asarray(Y)
+        if diag:
+            return np.exp(-0.5 * ((X - Y) ** 2).sum(1))
+        return np.exp(-0.5 * ((X[:, np.newaxis] - Y[np.newaxis]) ** 2).sum(2))
+
+
+def test_untraceable_kernel():
+    X = rng.randn(10, 2)
+    k = NumpyGaussianKernel()
+    K = k(X)
+    for pps in (None, 5):
+        rv = FiniteVec(k, X, np.ones(10), points_per_split = pps)
+        ref = K if pps is None else K.reshape((2, 5, 2, 5)).sum((1, 3))
+        assert np.allclose(inner(rv), ref, atol = 1e-5)
+        assert np.allclose(rv.inner(full = False), np.diagonal(ref), atol = 1e-5)
+        assert np.allclose(rv.inner_tiled(tile = 4), ref, atol = 1e-5)
+    cv = CombVec(FiniteVec(k, X), FiniteVec(k, X), multiply)
+    assert np.allclose(cv.inner_batched([cv, cv])[1], cv.inner(), atol = 1e-6)
+
+
+def test_SKlKernel():
+    skl_kernels = pytest.importorskip("sklearn.gaussian_process.kernels")
+    X = rng.randn(10, 2)
+    k = SKlKernel(skl_kernels.RBF(1.))
+    assert np.allclose(inner(FiniteVec(k, X, np.ones(10))), NumpyGaussianKernel()(X), atol = 1e-5)
+
+
+def test_SplitDimsKernel_array_intervals():
+    X = rng.randn(10, 2)
+    k = SplitDimsKernel(np.array([0, 1, 2]), [GaussianKernel(0.5), GaussianKernel(1.)])
+    assert np.allclose(inner(FiniteVec(k, X, np.ones(10))), k(X), atol = 1e-6)
+
+
+def test_inner_diag(kernel = kernel_setups[0]):
+    X = rng.randn(10, 2)
+    for rv in [FiniteVec(kernel, X, np.arange(10.) + 1), FiniteVec(kernel, X, np.arange(10.) + 1, points_per_split = 5)]:
+        assert rv.inner(full = False).shape == (len(rv),)
+        assert np.allclose(rv.inner(full = False), np.diagonal(inner(rv)), atol = 1e-6)
+
+
+def test_eq(kernel = kernel_setups[0]):
+    X = rng.randn(10, 2)
+    rv = FiniteVec(kernel, X)
+    assert rv == rv
+    assert rv == FiniteVec(kernel, X.copy())
+    assert not rv == FiniteVec(kernel, X + 1)
+    assert not rv == FiniteVec(kernel, X[:5])
+    assert not rv == rv.updated(2 * rv.prefactors)
+
+
+@pytest.mark.parametrize('tile', [1, 4, 256])
+def test_inner_tiled(tile, kernel = kernel_setups[0]):
+    X = rng.randn(10, 2)
+    rv = FiniteVec(kernel, X)
+    bv = FiniteVec(kernel, X, points_per_split = 5)
+    el = FiniteVec.construct_RKHS_Elem(kernel, rng.randn(7, 2))
+    for (v1, v2) in [(rv, rv), (rv, el), (bv, el), (bv, rv), (el, bv)]:
+        assert np.allclose(v1.inner_tiled(v2, tile = tile), inner(v1, v2), atol = 1e-6)
+
+
+def test_mixed_precision(kernel = kernel_setups[0]):
+    X = rng.randn(10, 2)
+    for pps in (None, 5):
+        mixed = FiniteVec(kernel, X, points_per_split = pps, precision = "mixed_bf16")
+        default = FiniteVec(kernel, X, points_per_split = pps)
+        assert inner(mixed).dtype == np.float32
+        assert np.allclose(inner(mixed), inner(default), rtol = 0.05, atol = 1e-3)
+        assert mixed.updated(mixed.prefactors).precision == "mixed_bf16"
+        cached = FiniteVec(kernel, X, points_per_split = pps, precision = "mixed_bf16", cache_self_gram = True)
+        assert cached.K_self.dtype == bfloat16
+        assert np.allclose(inner(cached), inner(default), rtol = 0.05, atol = 1e-3)
+
+    # prefactors are not rounded to bfloat16
+    p = 1 + 1e-3 * np.arange(10.)
+    weighted = FiniteVec(kernel, X, p, precision = "mixed_bf16")
+    assert np.allclose(inner(weighted), np.outer(p, p) * inner(FiniteVec(kernel, X, np.ones(10), precision = "mixed_bf16")), rtol = 1e-6)